@@ -12,82 +12,186 @@ modular functions that can be called in sequence to perform the ETL process.
 if the functions fail we can catch the exceptions and update the job status accordingly in the calling code
 """
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 import asyncio
-import psycopg2 as pg
-from typing import Dict, Any
+import asyncpg
+import redis.asyncio as aioredis
+from numba import njit
+from typing import Callable, List, Optional, Iterator
+from concurrent.futures import Executor
+from concurrent.futures.process import BrokenProcessPool
 import os
 
-async def extract_data(filename: str) -> pd.DataFrame:
+# column types for the CSV reader, the columns come out already typed
+# timestamps are kept as strings here and parsed during transformation
+# low-cardinality columns are dictionary-encoded, each row holds an integer code into the column's dictionary
+CSV_COLUMN_TYPES = {
+    'study_id': pa.dictionary(pa.int32(), pa.string()),
+    'participant_id': pa.string(),
+    'measurement_type': pa.dictionary(pa.int32(), pa.string()),
+    'value': pa.float64(),
+    'unit': pa.dictionary(pa.int32(), pa.string()),
+    'timestamp': pa.string(),
+    'site_id': pa.dictionary(pa.int32(), pa.string()),
+    'quality_score': pa.float64(),
+}
+MEASUREMENT_COLUMNS = list(CSV_COLUMN_TYPES)
+CATEGORICAL_COLUMNS = [column for column, type_ in CSV_COLUMN_TYPES.items() if pa.types.is_dictionary(type_)]
+
+def _pandas_type(type_: pa.DataType) -> Optional[pd.api.extensions.ExtensionDtype]:
+    # dictionary columns fall through to pandas' own conversion, which turns them into categoricals
+    return None if pa.types.is_dictionary(type_) else pd.ArrowDtype(type_)
+
+# bytes of CSV parsed per chunk, bounds how much raw data is held in memory at once
+CSV_BLOCK_SIZE = 64 << 20
+
+def extract_data(filename: str) -> Iterator[pd.DataFrame]:
     """
-    File extraction from provided CSV files
+    File extraction from provided CSV files, streamed in chunks so large files never have to be held in memory at once
 
     Input: filename
 
-    Output: DataFrame containing raw CSV data
+    Output: DataFrames containing consecutive chunks of raw CSV data, with rows missing any value already dropped
 
     Possibly throws:
     - FileNotFoundError: If the file does not exist
-    - pd.errors.EmptyDataError: If the file is empty
-    - pd.errors.ParserError: If the file is malformed
+    - pa.ArrowInvalid: If the file is empty, malformed, or a column can't be parsed as its expected type
     """
     DATA_DIR = "/app/data/" # derived from docker config
     filename = DATA_DIR + filename
 
-    await asyncio.sleep(1)  # Simulate I/O delay
-    data = pd.read_csv(filename)
-    return data
+    reader = pa_csv.open_csv(filename,
+                             read_options=pa_csv.ReadOptions(use_threads=True, block_size=CSV_BLOCK_SIZE),
+                             convert_options=pa_csv.ConvertOptions(column_types=CSV_COLUMN_TYPES,
+                                                                   strings_can_be_null=True))
+    for batch in reader:
+        # drop rows with any missing values while still in Arrow
+        batch = batch.drop_null()
+        # non-dictionary columns stay Arrow-backed
+        yield batch.to_pandas(types_mapper=_pandas_type)
 
-async def transform_data(data: pd.DataFrame) -> pd.DataFrame:
+def _best_rows(candidates: pd.DataFrame) -> pd.Index:
+    # index labels of the highest quality_score row per participant_id/measurement_type
+    # groups are neither sorted nor created for unused categories
+    return candidates.groupby(['participant_id', 'measurement_type'], sort=False, observed=True)['quality_score'].idxmax()
+
+def transform_data(data: pd.DataFrame) -> pd.DataFrame:
     """
     Data transformation to clean and standardize the data:
     Missing values handling, normalization, type conversion
 
-    - Any rows with missing values should be skipped:
+    - Any rows with missing values should be skipped (done on the Arrow side by extract_data):
         - depending on company policy there could be processes for recovering missing fields but for demo purposes just drop rows
     - Repeated participant_id/measurement combos should be handled by keeping the highest quality_score entry
-    - Convert data types from generic object (e.g. timestamps to datetime objects, numeric fields to appropriate types, etc)
+    - Convert timestamps to datetime objects (other columns are already typed by the schema applied in extract_data)
 
-    Columns: (type inferred from sample data)
-    study_id: str
-    participant_id: str
-    measurement_type: str
-    value: float
-    unit: str
-    timestamp: str (parsable datetime)
-    site_id: str
-    quality_score: float
+    Columns: (as read by extract_data, see CSV_COLUMN_TYPES)
+    study_id: category
+    participant_id: str (Arrow-backed)
+    measurement_type: category
+    value: float (Arrow-backed)
+    unit: category
+    timestamp: str (parsable datetime), converted to datetime64[ns, UTC]
+    site_id: category
+    quality_score: float (Arrow-backed)
 
-    Input: data (DataFrame)
+    Input: data (DataFrame), either a whole file or one chunk of it
 
     Output: Transformed DataFrame
 
     Possibly throws:
-    - ValueError/AssertionError: If data types cannot be converted as expected
+    - ValueError: If data types cannot be converted as expected
     - KeyError: If expected columns are missing
     """
+    # convert timestamps, all of them are ISO 8601
+    # each chunk frame is freshly built by extract_data, so the column can be replaced in place
+    data['timestamp'] = pd.to_datetime(data['timestamp'], format='ISO8601', utc=True, errors='coerce')
+
+    # rows whose timestamp failed to parse are the only ones left to drop, other missing values were filtered in extract_data
+    # the mask is applied to only the three columns deduplication needs,
+    # the full frame is gathered once, for the rows that are kept
+    parsed = data['timestamp'].notna()
+    candidates = data if parsed.all() else data.loc[parsed, ['participant_id', 'measurement_type', 'quality_score']]
 
-    await asyncio.sleep(1)  # Simulate processing delay
-    data = data.dropna()  # Drop rows with any missing values
-
-    # convert timestamps
-    data['timestamp'] = pd.to_datetime(data['timestamp'], errors='coerce')
-    data = data.dropna(subset=['timestamp'])  # Drop rows where timestamp conversion failed
-
-    # convert data types
-    data = data.convert_dtypes()
-    assert data['study_id'].dtype           == 'string[python]'
-    assert data['participant_id'].dtype     == 'string[python]'
-    assert data['measurement_type'].dtype   == 'string[python]'
-    assert data['value'].dtype              == 'Float64'
-    assert data['unit'].dtype               == 'string[python]'
-    assert data['timestamp'].dtype          == 'datetime64[ns, UTC]'
-    assert data['site_id'].dtype            == 'string[python]'
-    assert data['quality_score'].dtype      == 'Float64'
-    
     # drop duplicate participant_id/measurement_type keeping highest quality_score
-    data = data.sort_values(by='quality_score', ascending=False).drop_duplicates(subset=['participant_id', 'measurement_type'], keep='first')
-    return data
+    return data.loc[_best_rows(candidates)]
+
+def merge_data(chunks: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Combine individually transformed chunks of a file into a single DataFrame
+
+    Each chunk has already been deduplicated on its own, so only the per-chunk winners are held in memory,
+    but the same participant_id/measurement_type can still appear in more than one chunk
+
+    Input: List of transformed DataFrames
+
+    Output: Merged DataFrame keeping the highest quality_score entry across all chunks
+    """
+    if not chunks:
+        # header-only file, run an empty frame through so the columns still get their types
+        empty = pa.schema(CSV_COLUMN_TYPES).empty_table().to_pandas(types_mapper=_pandas_type)
+        return transform_data(empty)
+    if len(chunks) == 1:
+        # files smaller than one block are already fully deduplicated by transform_data
+        return chunks[0]
+    # index labels are only unique within a chunk so the merged frame needs a fresh index
+    data = pd.concat(chunks, ignore_index=True)
+    # each chunk is dictionary-encoded on its own, so concat falls back to plain objects when their categories differ
+    # only those columns are re-cast, and copy=False leaves every other column's data where it is
+    lost = {column: 'category' for column in CATEGORICAL_COLUMNS if not isinstance(data[column].dtype, pd.CategoricalDtype)}
+    data = data.astype(lost, copy=False)
+    return data.loc[_best_rows(data)]
+
+def init_worker(arrow_threads: int) -> None:
+    """
+    Process pool initializer, gives each worker a share of the CPUs for Arrow's CSV parsing
+    so the workers together don't run more threads than there are cores
+    """
+    pa.set_cpu_count(arrow_threads)
+
+def extract_and_transform(filename: str) -> pd.DataFrame:
+    """
+    Runs extraction, transformation and merging for a file, the CPU-bound half of the pipeline
+    Meant to be run in a worker process so concurrent jobs don't contend for the service's GIL
+
+    Input: filename
+
+    Output: Transformed DataFrame ready for validation
+    """
+    # each chunk is transformed as it's read, only one raw chunk is in memory at a time
+    return merge_data([transform_data(chunk) for chunk in extract_data(filename)])
+
+@njit(cache=True, nogil=True)
+def _numeric_checks(value: np.ndarray, quality_score: np.ndarray, timestamp: np.ndarray, now: int) -> bool:
+    # single fused pass over the numeric columns
+    for i in range(value.size):
+        if value[i] < 0 or quality_score[i] < 0 or quality_score[i] > 1 or timestamp[i] > now:
+            return False
+    return True
+
+def _validate_sync(data: pd.DataFrame) -> bool:
+    # checks are ordered cheapest first and bail out on the first failure
+    # the kernel reads zero-copy views of the columns (asi8 is the UTC nanosecond int64 view of the timestamps)
+    now = pd.Timestamp.now(tz='UTC')
+    if not _numeric_checks(data['value'].to_numpy(dtype=np.float64),
+                           data['quality_score'].to_numpy(dtype=np.float64),
+                           data['timestamp'].array.asi8,
+                           now.value):
+        return False
+    # All units for a measurement type should be the same
+    if not (data.groupby('measurement_type', sort=False, observed=True)['unit'].nunique() == 1).all():
+        return False
+    return True
+
+def compile_kernels() -> None:
+    """
+    Compile the validation kernel (or load it from Numba's on-disk cache) before the first job needs it,
+    by validating an empty frame with the same column types a real file produces
+    """
+    _validate_sync(merge_data([]))
 
 async def validate_data(data: pd.DataFrame) -> bool:
     """
@@ -105,92 +209,95 @@ async def validate_data(data: pd.DataFrame) -> bool:
 
     Output: Boolean indicating if data passed validation
     """
-    await asyncio.sleep(1)  # Simulate processing delay
-    try:
-        assert all(data['value'] >= 0)
-        assert all(data['quality_score'].between(0, 1))
-        assert all(data['timestamp'] <= pd.Timestamp.now(tz='UTC'))
-        for _, group in data.groupby('measurement_type'):
-            assert len(group['unit'].unique()) == 1  # All units for a measurement type should be the same
-        return True
-    except AssertionError:
-        return False
+    return await asyncio.to_thread(_validate_sync, data)
+
+async def create_db_pool() -> asyncpg.Pool:
+    """
+    Create the Postgres connection pool shared by all ETL jobs
+    """
+    username, pw, db = os.getenv("POSTGRES_USER") or "user", os.getenv("POSTGRES_PASSWORD") or "pass", os.getenv("POSTGRES_DB") or "clinical_data"
+    postgres_url = os.getenv("POSTGRES_URL") or "postgres"
+    # min_size=0 opens connections lazily on first load, so startup doesn't depend on Postgres being ready yet
+    return await asyncpg.create_pool(user=username,
+                                     password=pw,
+                                     host=postgres_url,
+                                     port=5432,
+                                     database=db,
+                                     min_size=0,
+                                     max_size=16)
+
+def _serialize_sync(data: pd.DataFrame) -> bytes:
+    return data.to_csv(columns=MEASUREMENT_COLUMNS, index=False, header=False).encode()
 
-async def load_data(data: pd.DataFrame) -> None:
+async def load_data(data: pd.DataFrame, pool: asyncpg.Pool) -> None:
     """
     Database loading to insert the processed data into the Postgres database
 
-    Input: Dataframe with validated data
+    Input: Dataframe with validated data, connection pool to load it through
 
     Output: None
     """
-    await asyncio.sleep(1)  # Simulate I/O
-    username, pw, db = os.getenv("POSTGRES_USER") or "user", os.getenv("POSTGRES_PASSWORD") or "pass", os.getenv("POSTGRES_DB") or "clinical_data"
-    postgres_url = os.getenv("POSTGRES_URL") or "postgres"
-    connection = None
+    # serialising to CSV is CPU work so keep it off the event loop
+    buffer = await asyncio.to_thread(_serialize_sync, data)
     try:
-        connection = pg.connect(user=username,
-                                password=pw,
-                                host=postgres_url,
-                                port="5432",
-                                database=db)
-        cursor = connection.cursor()
-        for _, row in data.iterrows():
-            insert_query = """
-            INSERT INTO clinical_measurements (study_id, participant_id, measurement_type, value, unit, timestamp, site_id, quality_score)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            """
-            cursor.execute(insert_query, (
-                row['study_id'],
-                row['participant_id'],
-                row['measurement_type'],
-                row['value'],
-                row['unit'],
-                row['timestamp'],
-                row['site_id'],
-                row['quality_score']
-            ))
-        connection.commit()
-    except (Exception, pg.Error) as error:
-        print(error)
-        if connection:
-            connection.rollback()
+        # stream the frame into the table with COPY
+        async with pool.acquire() as connection:
+            # wrapped in a memoryview because asyncpg treats bytes as a file path
+            await connection.copy_to_table('clinical_measurements',
+                                           source=memoryview(buffer),
+                                           columns=MEASUREMENT_COLUMNS,
+                                           format='csv')
+    except (Exception, asyncpg.PostgresError) as error:
+        # log the type and message only, some errors carry the whole payload
+        print(f"{type(error).__name__}: {str(error)[:500]}")
         raise Exception('Database insertion failed')
-    finally:
-        if (connection):
-            cursor.close()
-            connection.close()
 
-async def etl_pipeline(filename: str, jobs: Dict[str, Dict[str, Any]], job_id: str) -> None:
+# finished jobs are kept for a day before Redis drops them
+JOB_TTL_SECONDS = 24 * 60 * 60
+
+def job_key(job_id: str) -> str:
+    """
+    Redis key of the hash holding a job's state
+    """
+    return f"job:{job_id}"
+
+async def finish_job(redis: aioredis.Redis, key: str, status: str, message: str) -> None:
+    """
+    Records a job's final status and restarts its expiry from now
+    """
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(key, mapping={"status": status, "message": message, "progress": 100})
+        pipe.expire(key, JOB_TTL_SECONDS)
+        await pipe.execute()
+
+async def etl_pipeline(filename: str, redis: aioredis.Redis, job_id: str, pool: asyncpg.Pool,
+                       executor: Executor, replace_executor: Callable[[Executor], None]) -> None:
     """
     Orchestrates the ETL process for a given file and updates job status accordingly
+
+    replace_executor is called with the executor if one of its worker processes died, so later jobs get a working pool
     """
+    key = job_key(job_id)
     try:
-        jobs[job_id]['message'] = "Extracting data"
-        data = await extract_data(filename)
-        jobs[job_id]['progress'] = 25
+        await redis.hset(key, "message", "Extracting and transforming data")
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(executor, extract_and_transform, filename)
+        await redis.hset(key, mapping={"progress": 50, "message": "Validating data"})
 
-        jobs[job_id]['message'] = "Transforming data"
-        data = await transform_data(data)
-        jobs[job_id]['progress'] = 50
-
-        jobs[job_id]['message'] = "Validating data"
         is_valid = await validate_data(data)
         if not is_valid:
-            jobs[job_id]['status'] = 'failed'
-            jobs[job_id]['message'] = 'Data validation failed'
-            jobs[job_id]['progress'] = 100
+            await finish_job(redis, key, "failed", "Data validation failed")
             return
-        jobs[job_id]['progress'] = 75
-
-        jobs[job_id]['message'] = "Loading data into database"
-        await load_data(data)
-        jobs[job_id]['progress'] = 100
+        await redis.hset(key, mapping={"progress": 75, "message": "Loading data into database"})
 
-        jobs[job_id]['status'] = 'completed'
-        jobs[job_id]['message'] = 'ETL process completed successfully'
+        await load_data(data, pool)
+        await finish_job(redis, key, "completed", "ETL process completed successfully")
+    except asyncio.CancelledError:
+        # the service is shutting down, so the job will never finish
+        await finish_job(redis, key, "failed", "ETL process failed: service shut down before the job finished")
+        raise
+    except BrokenProcessPool as e:
+        replace_executor(executor)
+        await finish_job(redis, key, "failed", f"ETL process failed: worker process died: {str(e)}")
     except Exception as e:
-        jobs[job_id]['status'] = 'failed'
-        jobs[job_id]['message'] = f'ETL process failed: {str(e)}'
-        jobs[job_id]['progress'] = 100
-    
\ No newline at end of file
+        await finish_job(redis, key, "failed", f"ETL process failed: {str(e)}")
@@ -1,16 +1,69 @@
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 from typing import Optional, Dict, Any
+from contextlib import asynccontextmanager
+from concurrent.futures import Executor, ProcessPoolExecutor
+import multiprocessing
+import redis.asyncio as aioredis
 import uvicorn
 import os
-from .data_processing import etl_pipeline
+from .data_processing import etl_pipeline, create_db_pool, compile_kernels, init_worker, job_key, JOB_TTL_SECONDS
 import asyncio
 
-app = FastAPI(title="Clinical Data ETL Service", version="1.0.0")
+def make_executor() -> ProcessPoolExecutor:
+    """
+    Creates the worker process pool that extraction and transformation run in
+    """
+    # extraction and transformation run in worker processes so concurrent jobs don't serialise on the GIL
+    # workers are spawned, since forking a process that already has threads running isn't safe
+    # each worker's Arrow thread pool is limited to its share of the cores
+    cpus = os.cpu_count() or 1
+    workers = max(1, int(os.getenv("ETL_WORKERS") or min(4, cpus)))
+    return ProcessPoolExecutor(max_workers=workers,
+                               mp_context=multiprocessing.get_context("spawn"),
+                               initializer=init_worker,
+                               initargs=(max(1, cpus // workers),))
+
+def replace_executor(broken: Executor) -> None:
+    """
+    Swaps a broken worker pool for a fresh one, since a worker dying (e.g. OOM-killed) leaves the whole pool unusable
+    """
+    # every job running on the broken pool fails, only the first one to get here replaces it
+    if app.state.executor is broken:
+        app.state.executor = app.state.make_executor()
+        broken.shutdown(wait=False)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # one connection pool shared across jobs
+    app.state.pg = await create_db_pool()
+    # job state lives in Redis (one hash per job) so every worker sees the same jobs
+    app.state.redis = aioredis.from_url(os.getenv("REDIS_URL") or "redis://redis:6379", decode_responses=True)
+    # JIT the validation kernel at startup
+    await asyncio.to_thread(compile_kernels)
+    app.state.make_executor = make_executor
+    app.state.executor = make_executor()
+    yield
+    # cancelled jobs mark themselves failed, so this has to happen while Redis is still open
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    # waiting for running jobs to finish blocks, so do it off the event loop
+    await asyncio.to_thread(app.state.executor.shutdown, cancel_futures=True)
+    await app.state.redis.aclose()
+    await app.state.pg.close()
 
-# In-memory job storage (for demo purposes)
-# In production, this would use a proper database or job queue
-jobs: Dict[str, Dict[str, Any]] = {}
+app = FastAPI(title="Clinical Data ETL Service", version="1.0.0", lifespan=lifespan)
+
+# create a job's hash only if it doesn't already exist, ARGV[1] is its TTL and the rest are its fields
+CREATE_JOB_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
 
 # ensure asyncio tasks are tracked with strong references so they don't get garbage collected
 tasks = set()
@@ -42,22 +95,25 @@ async def submit_job(job_request: ETLJobRequest):
     """
     job_id = job_request.jobId
 
-    # if the job already exists then raise an exception since we don't want to overwrite the existing job
-    if job_id in jobs:
-        raise HTTPException(status_code=400, detail="Job ID already exists")
-    
-    # Store job in memory (simplified for demo)
-    jobs[job_id] = {
+    job = {
         "jobId": job_id,
         "filename": job_request.filename,
-        "studyId": job_request.studyId,
         "status": "running",
         "progress": 0,
         "message": "Job started"
     }
+    # Redis can't store None, a missing studyId is read back as None instead
+    if job_request.studyId is not None:
+        job["studyId"] = job_request.studyId
+
+    # if the job already exists then raise an exception since we don't want to overwrite the existing job
+    # the check and the write happen in one script so two workers can't both accept the same job
+    args = [item for field in job.items() for item in field]
+    if not await app.state.redis.eval(CREATE_JOB_SCRIPT, 1, job_key(job_id), JOB_TTL_SECONDS, *args):
+        raise HTTPException(status_code=400, detail="Job ID already exists")
     
     # run the ETL process asynchronously
-    task = asyncio.create_task(etl_pipeline(job_request.filename, jobs, job_id))
+    task = asyncio.create_task(etl_pipeline(job_request.filename, app.state.redis, job_id, app.state.pg, app.state.executor, replace_executor))
     tasks.add(task)
     task.add_done_callback(tasks.discard)
 
@@ -67,15 +123,24 @@ async def submit_job(job_request: ETLJobRequest):
         message="Job submitted successfully"
     )
 
+async def get_job(job_id: str) -> Dict[str, Any]:
+    """
+    Fetch a job's state from Redis, converting fields back from their stored string form
+    """
+    job = await app.state.redis.hgetall(job_key(job_id))
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    job["progress"] = int(job["progress"])
+    job.setdefault("studyId", None)
+    return job
+
 @app.get("/jobs/{job_id}/status", response_model=ETLJobStatus)
 async def get_job_status(job_id: str):
     """
     Get the current status of an ETL job
     """
-    if job_id not in jobs:
-        raise HTTPException(status_code=404, detail="Job not found")
-    
-    job = jobs[job_id]
+    job = await get_job(job_id)
     return ETLJobStatus(
         jobId=job_id,
         status=job["status"],
@@ -88,10 +153,7 @@ async def get_job_details(job_id: str):
     """
     Get detailed information about an ETL job
     """
-    if job_id not in jobs:
-        raise HTTPException(status_code=404, detail="Job not found")
-    
-    return jobs[job_id]
+    return await get_job(job_id)
 
 if __name__ == "__main__":
     uvicorn.run(